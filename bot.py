@@ -1,14 +1,30 @@
 import logging
 import os
 import requests
-import pandas as pd
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.compute as pc
 import datetime
 import pytz
 import asyncio
 import sqlite3
 import html
 import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import json
+import io
+import codecs
+import hashlib
+import csv
+import operator
 from telegram import Update
+from telegram.error import Forbidden, RetryAfter
 from telegram.ext import (
     ApplicationBuilder, 
     ContextTypes, 
@@ -37,7 +53,19 @@ logging.basicConfig(
 ADMIN_CHAT_ID = 889325852
 DB_FILE = "bankrupt.db"
 COMPANIES_FILE_TXT = "companies.txt"
+API_URL = 'https://data.gov.ua/api/3/action/package_show?id=544d4dad-0b6d-4972-b0b8-fb266829770f'
+FALLBACK_RESOURCE_URL = 'https://data.gov.ua/dataset/544d4dad-0b6d-4972-b0b8-fb266829770f/resource/deb76481-a6c8-4a45-ae6c-f02aa87e9f4a/download/vidomosti-pro-spravi-pro-bankrutstvo.csv'
+RESOURCE_URL_TTL = 6 * 3600 # Секунд, в течение которых ссылка на CSV не перезапрашивается
+REFRESH_TTL = 600 # Секунд, в течение которых свежая база не перепроверяется
+BROADCAST_CONCURRENCY = 20 # Сколько пользователей обрабатываем одновременно при рассылке
+BROADCAST_RATE = 25 # Сообщений в секунду при рассылке (общий лимит Telegram ~30/с)
 GLOBAL_START_DATE = datetime.datetime.strptime("01.01.2025", "%d.%m.%Y").date()
+GLOBAL_START_ISO = GLOBAL_START_DATE.isoformat() # ISO-даты сравниваются как строки
+# Версия формата таблицы bankrupts: при изменении импорта кэш ETag сбрасывается
+REGISTRY_VERSION = 3
+# Единственные колонки реестра, которые использует бот
+REGISTRY_COLUMNS = ('firm_edrpou', 'firm_name', 'date')
+FALLBACK_CHUNK_ROWS = 100_000 # Размер куска для запасного парсера csv
 
 # Состояния для ConversationHandler
 FIND_WAITING_CODE = 1
@@ -46,20 +74,85 @@ DEL_WAITING_CODE = 3
 
 # --- ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ ---
 
+CREATE_BANKRUPTS_SQL = """
+    CREATE TABLE IF NOT EXISTS bankrupts (
+        firm_edrpou TEXT,
+        firm_name TEXT,
+        date TEXT,
+        date_iso TEXT
+    )
+"""
+# Покрывающий индекс: поиск по коду отвечается из индекса, без чтения строк таблицы
+CREATE_BANKRUPTS_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS idx_edrpou_cover
+    ON bankrupts (firm_edrpou, date_iso, date, firm_name)
+"""
+
+# Настройки соединения (действуют только на текущее соединение, поэтому задаются при каждом открытии):
+# при WAL synchronous=NORMAL безопасен и не делает fsync на каждый коммит, временные данные
+# и кэш страниц держим в памяти
+DB_PRAGMAS = """
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA mmap_size=268435456;
+"""
+
+def db_connect():
+    """Открывает соединение с БД с общими настройками DB_PRAGMAS."""
+    # Пока идет импорт реестра, ждем блокировку до 5 с, а не падаем (это же значение по умолчанию в sqlite3)
+    conn = sqlite3.connect(DB_FILE, timeout=5.0)
+    conn.executescript(DB_PRAGMAS)
+    return conn
+
+# Долгоживущее соединение только для чтения: подготовленные запросы остаются в его кэше
+# между вызовами. Handlers работают из разных потоков to_thread, поэтому доступ под замком
+_read_conn = None
+_read_conn_lock = threading.Lock()
+
+def db_read(sql, params=()):
+    """Выполняет читающий запрос на общем соединении и возвращает все строки."""
+    global _read_conn
+    with _read_conn_lock:
+        if _read_conn is None:
+            _read_conn = sqlite3.connect(
+                f"file:{DB_FILE}?mode=ro", uri=True, check_same_thread=False, cached_statements=256
+            )
+            _read_conn.executescript(DB_PRAGMAS)
+        return _read_conn.execute(sql, params).fetchall()
+
 def init_db():
-    """Создает сложную структуру БД для многопользовательского режима."""
-    with sqlite3.connect(DB_FILE) as conn:
+    """Создает сложную структуру БД для многопользовательского режима.
+
+    Возвращает True, если реестр нужно загрузить сразу (пуст или в старом формате).
+    """
+    with db_connect() as conn:
         cursor = conn.cursor()
         
-        # 1. Таблица сырых данных (общий реестр)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS bankrupts (
-                firm_edrpou TEXT,
-                firm_name TEXT,
-                date TEXT
-            )
-        """)
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_edrpou ON bankrupts (firm_edrpou)")
+        # WAL сохраняется в файле БД (рядом появляются служебные -wal и -shm): читатели
+        # не блокируют запись истории во время рассылки, а импорт реестра не блокирует /check
+        cursor.execute("PRAGMA journal_mode=WAL")
+
+        # 1. Таблица сырых данных (общий реестр).
+        # В таблицу старого формата добавляем date_iso и заполняем ее из date прямо в SQL,
+        # чтобы /find и /check работали сразу, не дожидаясь повторной загрузки реестра
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(bankrupts)")}
+        migrated = bool(columns) and 'date_iso' not in columns
+        if migrated:
+            if set(REGISTRY_COLUMNS) <= columns:
+                cursor.execute("ALTER TABLE bankrupts ADD COLUMN date_iso TEXT")
+                cursor.execute("""
+                    UPDATE bankrupts
+                    SET date_iso = substr(trim(date), 7, 4) || '-' || substr(trim(date), 4, 2) || '-' || substr(trim(date), 1, 2)
+                    WHERE trim(date) GLOB '[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]*'
+                """)
+            else:
+                # Нужных колонок нет — переносить нечего, реестр загрузится при старте
+                cursor.execute("DROP TABLE bankrupts")
+        cursor.execute("DROP INDEX IF EXISTS idx_edrpou")
+        cursor.execute(CREATE_BANKRUPTS_SQL)
+        cursor.execute(CREATE_BANKRUPTS_INDEX_SQL)
+        is_empty = cursor.execute("SELECT 1 FROM bankrupts LIMIT 1").fetchone() is None
 
         # 2. Таблица пользователей (статус подписки)
         cursor.execute("""
@@ -90,117 +183,404 @@ def init_db():
             )
         """)
         
+        # 5. Служебные метаданные (ETag / Last-Modified последнего скачанного реестра)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        
         # МИГРАЦИЯ
         cursor.execute("INSERT OR IGNORE INTO users (chat_id, is_active) SELECT DISTINCT chat_id, 1 FROM subscriptions")
         conn.commit()
 
+    # Пустой или перенесенный из старого формата реестр загружаем сразу при старте
+    return is_empty or migrated
+
 # --- ЯДРО: ОБНОВЛЕНИЕ БАЗЫ (ГЛОБАЛЬНОЕ) ---
 
-def update_database_logic():
-    """Скачивает CSV и обновляет общую таблицу bankrupts."""
-    logging.info("Начало скачивания базы...")
+def db_get_meta(key):
+    """Читает JSON-значение из служебной таблицы meta ({} если нет или битое)."""
+    with db_connect() as conn:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    if not row:
+        return {}
+    try:
+        return json.loads(row[0])
+    except ValueError:
+        return {}
+
+def db_set_meta(key, value):
+    with db_connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, json.dumps(value))
+        )
 
-    # 1. Получаем ссылку на файл
+def db_get_download_meta():
+    """Возвращает сохраненные url/etag/last_modified последней успешной загрузки."""
+    with db_connect() as conn:
+        # Если таблица реестра пуста — кэш недействителен, качаем заново
+        has_data = conn.execute("SELECT 1 FROM bankrupts LIMIT 1").fetchone()
+    meta = db_get_meta('download') if has_data else {}
+    return meta if meta.get('version') == REGISTRY_VERSION else {}
+
+def db_set_download_meta(meta):
+    db_set_meta('download', meta)
+
+# Одна сессия на все загрузки реестра: TCP/TLS-соединение переиспользуется между
+# попытками и запасным скачиванием (обновления сериализованы через _refresh_lock)
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.headers.update({'User-Agent': 'bankrupt_bot'})
+# Кратковременные 5xx и обрывы соединения повторяет сам urllib3 (с нарастающей паузой);
+# цикл попыток в update_database_logic остается для обрывов посреди скачивания
+HTTP_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+))
+
+def sniff_encoding(head):
+    """Определяет кодировку по первым байтам: BOM, затем проверка на валидный UTF-8.
+
+    Реестр публикуется в UTF-8, но если выборка не декодируется — это почти
+    наверняка cp1251 (старые выгрузки госреестров).
+    """
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
     try:
-        api_url = 'https://data.gov.ua/api/3/action/package_show?id=544d4dad-0b6d-4972-b0b8-fb266829770f'
-        resp = requests.get(api_url, timeout=15).json()
-        if resp.get('success'):
-            resource_url = resp['result']['resources'][-1]['url']
-        else:
-            resource_url = 'https://data.gov.ua/dataset/544d4dad-0b6d-4972-b0b8-fb266829770f/resource/deb76481-a6c8-4a45-ae6c-f02aa87e9f4a/download/vidomosti-pro-spravi-pro-bankrutstvo.csv'
-    except Exception as e:
-        return False, f"Ошибка API: {e}"
+        # final=False: многобайтовый символ, обрезанный на краю выборки, не ошибка
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp1251'
+
+def sniff_header(head, encoding='utf-8'):
+    """По строке заголовка определяет разделитель и исходные имена нужных колонок."""
+    lines = head.decode(encoding, errors='replace').lstrip('\ufeff').splitlines()
+    header = lines[0] if lines else ""
+    delimiter = max([',', ';', '\t'], key=header.count)
+    # В заголовке бывают пробелы вокруг имен — сопоставляем по очищенному имени
+    names = {name.strip(): name for name in next(csv.reader([header], delimiter=delimiter), [])}
+    return delimiter, [names.get(col, col) for col in REGISTRY_COLUMNS]
+
+class HashingReader(io.RawIOBase):
+    """Обертка над потоком, считающая SHA-1 всех прочитанных байт."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha1 = hashlib.sha1()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.raw.readinto(buffer)
+        self.sha1.update(memoryview(buffer)[:n])
+        return n
+
+def read_registry_arrow(stream):
+    """Читает CSV реестра многопоточным парсером Arrow прямо из потока ответа.
+
+    Возвращает pyarrow.Table с колонками REGISTRY_COLUMNS — без DataFrame.
+    """
+    stream = io.BufferedReader(stream, buffer_size=1 << 20)
+    head = stream.peek(4096)
+    encoding = sniff_encoding(head)
+    delimiter, columns = sniff_header(head, encoding)
+    # Читаем только нужные колонки и сразу как строки — без лишних копий и приведения типов
+    table = pa_csv.read_csv(
+        stream,
+        read_options=pa_csv.ReadOptions(encoding=encoding, block_size=1 << 20),
+        parse_options=pa_csv.ParseOptions(
+            delimiter=delimiter,
+            invalid_row_handler=lambda row: 'skip'
+        ),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=columns,
+            column_types={col: pa.string() for col in columns}
+        )
+    )
+    return table.rename_columns(list(REGISTRY_COLUMNS))
+
+def rows_to_table(rows):
+    """Переводит список строк (кортежей REGISTRY_COLUMNS) в pyarrow.Table."""
+    return pa.table(
+        [pa.array(column, type=pa.string()) for column in zip(*rows)],
+        names=list(REGISTRY_COLUMNS)
+    )
 
-    csv_file = "temp_bankrupt.csv"
-    download_success = False
+def read_registry_fallback(resource_url):
+    """Запасной путь: терпимый к ошибкам модуль csv из stdlib, тоже прямо из потока ответа.
+
+    Строки копятся кусками по FALLBACK_CHUNK_ROWS и сразу переводятся в Arrow,
+    поэтому весь файл в виде Python-объектов в памяти не лежит.
+    Возвращает (pyarrow.Table, sha1 файла).
+    """
+    with HTTP_SESSION.get(resource_url, stream=True, timeout=180) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        r.raw.auto_close = False
+        stream = HashingReader(r.raw)
+        buffered = io.BufferedReader(stream, buffer_size=1 << 20)
+        head = buffered.peek(65536)
+        encoding = sniff_encoding(head)
+        delimiter, columns = sniff_header(head, encoding)
+        text = io.TextIOWrapper(
+            buffered, encoding='utf-8-sig' if encoding == 'utf-8' else encoding,
+            errors='replace', newline=''
+        )
+        reader = csv.reader(text, delimiter=delimiter)
+        header = next(reader, [])
+        positions = [header.index(col) for col in columns]
+        width = max(positions) + 1
+        pick = operator.itemgetter(*positions)
+
+        batches = []
+        rows = []
+        for row in reader:
+            if len(row) < width: continue # Битые (обрезанные) строки пропускаем
+            rows.append(pick(row))
+            if len(rows) == FALLBACK_CHUNK_ROWS:
+                batches.append(rows_to_table(rows))
+                rows = []
+        if rows:
+            batches.append(rows_to_table(rows))
+    if not batches:
+        raise ValueError("CSV не содержит строк")
+    return pa.concat_tables(batches), stream.sha1.hexdigest()
+
+def normalize_registry(table):
+    """Векторно чистит колонки реестра и добавляет date_iso (YYYY-MM-DD, битые даты -> NULL)."""
+    code, name, date = (pc.utf8_trim_whitespace(table.column(col)) for col in REGISTRY_COLUMNS)
+    day = pc.replace_substring_regex(date, pattern=r'\s.*', replacement='')
+    date_iso = pc.strftime(
+        pc.strptime(day, format='%d.%m.%Y', unit='s', error_is_null=True), format='%Y-%m-%d'
+    )
+    return pa.table([code, name, date, date_iso], names=[*REGISTRY_COLUMNS, 'date_iso'])
+
+def db_replace_registry(table):
+    """Атомарно заменяет содержимое bankrupts пачками executemany в одной транзакции."""
+    with db_connect() as conn:
+        conn.execute("BEGIN")
+        # Пересоздаем таблицу: в старых базах у нее мог быть другой набор колонок
+        conn.execute("DROP TABLE IF EXISTS bankrupts")
+        conn.execute(CREATE_BANKRUPTS_SQL)
+        for batch in table.to_batches(max_chunksize=50000):
+            conn.executemany(
+                "INSERT INTO bankrupts (firm_edrpou, firm_name, date, date_iso) VALUES (?, ?, ?, ?)",
+                zip(*(column.to_pylist() for column in batch.columns))
+            )
+        # Индекс строим после вставки — это быстрее, чем обновлять его на каждой строке
+        conn.execute(CREATE_BANKRUPTS_INDEX_SQL)
+        # Свежая статистика, чтобы планировщик выбирал покрывающий индекс
+        conn.execute("ANALYZE bankrupts")
+
+# Общий асинхронный HTTP-клиент (httpx уже идет вместе с python-telegram-bot)
+HTTP_CLIENT = httpx.AsyncClient(
+    timeout=15,
+    headers={'User-Agent': 'bankrupt_bot'},
+    transport=httpx.AsyncHTTPTransport(retries=2) # повтор неудачных подключений
+)
+
+# Импорт реестра идет в отдельном процессе: перевод сотен тысяч строк в Python-объекты
+# и их вставка держат GIL и иначе тормозили бы обработку команд бота.
+# spawn вместо fork — в основном процессе уже работают потоки и event loop.
+# Пул создается лениво и пересоздается, если рабочий процесс погиб (OOM, падение pyarrow)
+_refresh_executor = None
+
+def get_refresh_executor():
+    """Возвращает пул для импорта реестра, создавая его при первом обращении."""
+    global _refresh_executor
+    if _refresh_executor is None:
+        _refresh_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    return _refresh_executor
+
+def reset_refresh_executor():
+    """Выбрасывает сломанный пул; следующий get_refresh_executor() создаст новый."""
+    global _refresh_executor
+    if _refresh_executor is not None:
+        _refresh_executor.shutdown(wait=False, cancel_futures=True)
+        _refresh_executor = None
+
+async def shutdown_resources(application):
+    await HTTP_CLIENT.aclose()
+    HTTP_SESSION.close()
+    reset_refresh_executor()
+    if _read_conn is not None:
+        _read_conn.close()
+
+# Ссылка на ресурс меняется редко: держим ее в памяти и в meta (теплый старт после рестарта)
+_resource_url_cache = {'url': None, 'ts': 0}
+
+def load_resource_url_cache():
+    """Подгружает закэшированную ссылку на ресурс из БД при старте."""
+    _resource_url_cache.update(db_get_meta('resource_url'))
+
+async def get_resource_url():
+    """Получает ссылку на актуальный CSV через API data.gov.ua, не блокируя event loop."""
+    cached_url = _resource_url_cache['url']
+    if cached_url and time.time() - _resource_url_cache['ts'] < RESOURCE_URL_TTL:
+        return cached_url
+    try:
+        resp = (await HTTP_CLIENT.get(API_URL)).json()
+    except Exception as e:
+        if not cached_url:
+            raise
+        logging.warning(f"⚠️ API недоступно ({e}), используем сохраненную ссылку.")
+        return cached_url
+    if not resp.get('success'):
+        return cached_url or FALLBACK_RESOURCE_URL
+    _resource_url_cache.update(url=resp['result']['resources'][-1]['url'], ts=time.time())
+    await asyncio.to_thread(db_set_meta, 'resource_url', dict(_resource_url_cache))
+    return _resource_url_cache['url']
+
+# Момент последнего успешного обновления (time.monotonic) и замок от параллельных обновлений
+_last_refresh = None
+_refresh_lock = asyncio.Lock()
+
+async def refresh_database(force=False):
+    """Находит ссылку на реестр и обновляет базу в рабочем потоке.
+
+    Если база обновлялась меньше REFRESH_TTL секунд назад, сеть не трогаем вовсе
+    (кроме force=True — ручного /update, где пользователь явно просит проверить реестр).
+    Параллельные вызовы ждут друг друга и переиспользуют свежий результат.
+    """
+    global _last_refresh
+    async with _refresh_lock:
+        if not force and _last_refresh is not None and time.monotonic() - _last_refresh < REFRESH_TTL:
+            return True, "База актуальна."
+
+        logging.info("Начало скачивания базы...")
+        try:
+            resource_url = await get_resource_url()
+        except Exception as e:
+            return False, f"Ошибка API: {e}"
+        loop = asyncio.get_running_loop()
+        # Одна повторная попытка на свежем пуле, если рабочий процесс погиб
+        for attempt in range(1, 3):
+            try:
+                res, msg = await loop.run_in_executor(get_refresh_executor(), update_database_logic, resource_url)
+                break
+            except BrokenProcessPool as e:
+                logging.error(f"❌ Процесс импорта погиб ({e}), пересоздаем пул (попытка {attempt}/2).")
+                reset_refresh_executor()
+                if attempt == 2:
+                    return False, f"Помилка процесу оновлення: {e}"
+            except Exception as e:
+                return False, f"Помилка процесу оновлення: {e}"
+        if res:
+            _last_refresh = time.monotonic()
+        return res, msg
+
+def update_database_logic(resource_url):
+    """Скачивает CSV и обновляет общую таблицу bankrupts."""
+    table = None
+    not_modified = False
     last_error = ""
 
-    # 2. Попытка скачивания с повторами (Retries)
+    # Условный GET: если реестр не менялся, сервер ответит 304 без тела
+    meta = db_get_download_meta()
+    headers = {}
+    if meta.get('url') == resource_url:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    # Скачивание и разбор с повторами (Retries)
     for attempt in range(1, 4): # 3 попытки
         try:
             logging.info(f"⬇️ Попытка скачивания {attempt}/3...")
-            with requests.get(resource_url, stream=True, timeout=180) as r:
+            with HTTP_SESSION.get(resource_url, stream=True, timeout=180, headers=headers) as r:
+                if r.status_code == 304:
+                    not_modified = True
+                    break
                 r.raise_for_status() # Проверка на ошибки 404, 500 и т.д.
-                with open(csv_file, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-            download_success = True
+                new_meta = {
+                    'version': REGISTRY_VERSION,
+                    'url': resource_url,
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                }
+                # Парсим прямо из сокета, без промежуточного файла на диске
+                r.raw.decode_content = True
+                r.raw.auto_close = False # иначе BufferedReader упадет на EOF
+                stream = HashingReader(r.raw)
+                try:
+                    table = read_registry_arrow(stream)
+                    digest = stream.sha1.hexdigest()
+                except pa.ArrowInvalid as e:
+                    logging.warning(f"⚠️ Arrow не смог разобрать CSV ({e}), читаем модулем csv.")
+            if table is None:
+                table, digest = read_registry_fallback(resource_url)
             logging.info("✅ Файл успешно скачан.")
             break # Выход из цикла, если успешно
         except Exception as e:
             last_error = str(e)
+            table = None
             logging.warning(f"⚠️ Ошибка при скачивании (попытка {attempt}): {e}")
-            if os.path.exists(csv_file): 
-                os.remove(csv_file) # Удаляем битый файл
             time.sleep(10) # Ждем 10 секунд перед следующей попыткой
 
-    if not download_success:
+    if not_modified:
+        logging.info("Реестр не изменился (304), пропускаем загрузку и импорт.")
+        return True, "База актуальна."
+
+    if table is None:
         return False, f"Не удалось скачать файл после 3 попыток. Последняя ошибка: {last_error}"
 
     try:
-        df = pd.read_csv(csv_file, sep=None, engine="python", on_bad_lines="skip", encoding="utf-8", encoding_errors='replace')
-        df.columns = df.columns.str.strip()
-        df['firm_edrpou'] = df['firm_edrpou'].astype(str).str.strip()
-        df['firm_name'] = df['firm_name'].astype(str).str.strip()
-        df['date'] = df['date'].astype(str).str.strip()
+        # Отпечаток содержимого: если сервер не отдает ETag, но файл тот же —
+        # не переписываем таблицу
+        new_meta['digest'] = digest
+        if new_meta['digest'] == meta.get('digest'):
+            db_set_download_meta(new_meta)
+            logging.info("Содержимое реестра не изменилось, импорт пропущен.")
+            return True, "База актуальна."
         
-        with sqlite3.connect(DB_FILE) as conn:
-            df.to_sql('bankrupts', conn, if_exists='replace', index=False)
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_edrpou ON bankrupts (firm_edrpou)")
+        db_replace_registry(normalize_registry(table))
+        db_set_download_meta(new_meta)
             
         logging.info("База обновлена.")
         return True, "База оновлена."
     except Exception as e:
         return False, f"Помилка імпорту: {e}"
-    finally:
-        if os.path.exists(csv_file): os.remove(csv_file)
 
 # --- ЛОГИКА: ПЕРСОНАЛЬНЫЙ ПОИСК ---
 
 def check_user_subscriptions(chat_id, save_history=True):
     """Проверяет банкротства ТОЛЬКО для конкретного пользователя."""
-    if not os.path.exists(DB_FILE): return [], "База пуста."
-
-    new_items = []
-    
-    with sqlite3.connect(DB_FILE) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         
-        user_codes = cursor.execute(
-            "SELECT firm_edrpou FROM subscriptions WHERE chat_id = ?", 
+        has_codes = cursor.execute(
+            "SELECT 1 FROM subscriptions WHERE chat_id = ? LIMIT 1", 
             (chat_id,)
-        ).fetchall()
+        ).fetchone()
         
-        if not user_codes:
+        if not has_codes:
             return [], "У вас немає активних підписок. Використайте /addcompany"
 
-        codes_list = [c[0] for c in user_codes]
-        
-        placeholders = ','.join('?' for _ in codes_list)
-        query = f"SELECT firm_edrpou, firm_name, date FROM bankrupts WHERE firm_edrpou IN ({placeholders})"
-        cursor.execute(query, codes_list)
-        matches = cursor.fetchall()
+        # Один JOIN подписок с реестром вместо выборки кодов + IN (?, ?, ...);
+        # старые и битые даты (date_iso IS NULL) отсекает сам SQLite по индексу,
+        # он же сортирует по дате — ISO-строки упорядочены так же, как даты.
+        # Уже отправленное отсекается анти-join'ом по первичному ключу sent_history
+        history_filter = """
+            AND NOT EXISTS (
+                SELECT 1 FROM sent_history h
+                WHERE h.chat_id = s.chat_id AND h.firm_edrpou = b.firm_edrpou AND h.date = b.date
+            )
+        """ if save_history else ""
+        matches = cursor.execute(f"""
+            SELECT b.firm_edrpou, b.firm_name, b.date
+            FROM subscriptions s
+            JOIN bankrupts b ON b.firm_edrpou = s.firm_edrpou
+            WHERE s.chat_id = ? AND b.date_iso > ? {history_filter}
+            ORDER BY b.date_iso
+        """, (chat_id, GLOBAL_START_ISO)).fetchall()
 
-        for code, name, date_str in matches:
-            try:
-                date_obj = datetime.datetime.strptime(date_str, "%d.%m.%Y").date()
-                if date_obj <= GLOBAL_START_DATE: continue
-            except: continue
-
-            if save_history:
-                seen = cursor.execute(
-                    "SELECT 1 FROM sent_history WHERE chat_id = ? AND firm_edrpou = ? AND date = ?", 
-                    (chat_id, code, date_str)
-                ).fetchone()
-                if seen: continue 
-
-            new_items.append({
-                "code": code,
-                "name": name,
-                "date": date_str,
-                "date_obj": date_obj
-            })
+        new_items = [{"code": code, "name": name, "date": date_str} for code, name, date_str in matches]
 
         if save_history and new_items:
             history_data = [(chat_id, i['code'], i['date']) for i in new_items]
@@ -209,10 +589,56 @@ def check_user_subscriptions(chat_id, save_history=True):
                 history_data
             )
             conn.commit()
-            
-    new_items.sort(key=lambda x: x["date_obj"])
+
     return new_items, "OK"
 
+def db_analyze_users():
+    """Обновляет статистику планировщика (sqlite_stat1) по таблицам пользователей.
+
+    bankrupts анализируется сразу после импорта; здесь — таблицы, которые растут
+    от рассылки. analysis_limit ограничивает выборку, чтобы ANALYZE оставался дешевым.
+    """
+    with db_connect() as conn:
+        conn.executescript("""
+            PRAGMA analysis_limit=1000;
+            ANALYZE users;
+            ANALYZE subscriptions;
+            ANALYZE sent_history;
+        """)
+
+def check_users_subscriptions(chat_ids):
+    """Проверяет подписки всех пользователей рассылки одним запросом.
+
+    Возвращает {chat_id: новые события}; история всех пользователей фиксируется одним коммитом.
+    """
+    user_items = {chat_id: [] for chat_id in chat_ids}
+    with db_connect() as conn:
+        # Тот же JOIN и анти-join, что и в check_user_subscriptions, но сразу для всех
+        matches = conn.execute("""
+            SELECT s.chat_id, b.firm_edrpou, b.firm_name, b.date
+            FROM subscriptions s
+            JOIN bankrupts b ON b.firm_edrpou = s.firm_edrpou
+            WHERE b.date_iso > ?
+            AND NOT EXISTS (
+                SELECT 1 FROM sent_history h
+                WHERE h.chat_id = s.chat_id AND h.firm_edrpou = b.firm_edrpou AND h.date = b.date
+            )
+            ORDER BY s.chat_id, b.date_iso
+        """, (GLOBAL_START_ISO,)).fetchall()
+
+        history_data = []
+        for chat_id, code, name, date_str in matches:
+            items = user_items.get(chat_id)
+            if items is None: continue # неактивный пользователь
+            items.append({"code": code, "name": name, "date": date_str})
+            history_data.append((chat_id, code, date_str))
+
+        conn.executemany(
+            "INSERT OR IGNORE INTO sent_history (chat_id, firm_edrpou, date) VALUES (?, ?, ?)",
+            history_data
+        )
+    return user_items
+
 # --- УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ И ПОДПИСКАМИ (SQL) ---
 
 #def db_set_user_active(chat_id, is_active=True):
@@ -225,7 +651,7 @@ def check_user_subscriptions(chat_id, save_history=True):
 def db_set_user_active(chat_id, is_active=True):
     """Возвращает True, если это новый пользователь."""
     is_new_user = False
-    with sqlite3.connect(DB_FILE) as conn:
+    with db_connect() as conn:
         # Проверяем наличие пользователя до вставки
         cursor = conn.execute("SELECT 1 FROM users WHERE chat_id = ?", (chat_id,))
         if not cursor.fetchone():
@@ -238,35 +664,82 @@ def db_set_user_active(chat_id, is_active=True):
     return is_new_user
 
 
+# Коды из companies.txt с моментом последнего чтения: (mtime_ns, коды)
+_txt_codes_cache = (None, ())
+
+def get_txt_codes():
+    """Коды из companies.txt (файл перечитывается, только если изменился его mtime)."""
+    global _txt_codes_cache
+    mtime = os.stat(COMPANIES_FILE_TXT).st_mtime_ns
+    if _txt_codes_cache[0] != mtime:
+        with open(COMPANIES_FILE_TXT, 'r', encoding='utf-8') as f:
+            codes = tuple(code for code in (line.strip() for line in f) if code.isdigit())
+        _txt_codes_cache = (mtime, codes)
+    return _txt_codes_cache[1]
+
+def db_add_subscriptions(chat_id, codes):
+    """Добавляет пачку кодов одной транзакцией. Возвращает число новых подписок."""
+    db_set_user_active(chat_id, True)
+    with db_connect() as conn:
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO subscriptions (chat_id, firm_edrpou) VALUES (?, ?)",
+            [(chat_id, code) for code in codes]
+        )
+        return conn.total_changes - before
+
 def db_add_subscription(chat_id, code):
-    with sqlite3.connect(DB_FILE) as conn:
-        try:
-            db_set_user_active(chat_id, True)
-            conn.execute("INSERT INTO subscriptions (chat_id, firm_edrpou) VALUES (?, ?)", (chat_id, code))
-            return True
-        except sqlite3.IntegrityError:
-            return False
+    return db_add_subscriptions(chat_id, [code]) > 0
 
 def db_del_subscription(chat_id, code):
-    with sqlite3.connect(DB_FILE) as conn:
+    with db_connect() as conn:
         cursor = conn.execute("DELETE FROM subscriptions WHERE chat_id = ? AND firm_edrpou = ?", (chat_id, code))
         return cursor.rowcount > 0
 
 def db_get_user_subscriptions(chat_id):
-    with sqlite3.connect(DB_FILE) as conn:
-        rows = conn.execute("SELECT firm_edrpou FROM subscriptions WHERE chat_id = ?", (chat_id,)).fetchall()
+    rows = db_read("SELECT firm_edrpou FROM subscriptions WHERE chat_id = ?", (chat_id,))
     return [r[0] for r in rows]
 
 def db_get_active_users():
-    with sqlite3.connect(DB_FILE) as conn:
-        rows = conn.execute("""
-            SELECT DISTINCT u.chat_id 
-            FROM users u
-            JOIN subscriptions s ON u.chat_id = s.chat_id
-            WHERE u.is_active = 1
-        """).fetchall()
+    rows = db_read("""
+        SELECT DISTINCT u.chat_id 
+        FROM users u
+        JOIN subscriptions s ON u.chat_id = s.chat_id
+        WHERE u.is_active = 1
+    """)
     return [r[0] for r in rows]
 
+# --- ФОРМАТИРОВАНИЕ ОТЧЕТОВ ---
+
+TELEGRAM_TEXT_LIMIT = 4000 # Запас до лимита Telegram в 4096 символов
+
+def split_for_telegram(text, limit=TELEGRAM_TEXT_LIMIT):
+    """Режет длинный текст на части до limit символов по границам строк (один проход, без split)."""
+    parts = []
+    start, n = 0, len(text)
+    while start < n:
+        end = min(start + limit, n)
+        cut = text.rfind('\n', start, end) if end < n else n
+        if cut <= start:
+            cut = end # Строка длиннее лимита — режем жестко
+        if text[start:cut].strip(): # Telegram не принимает пустые сообщения
+            parts.append(text[start:cut])
+        start = cut + 1 if cut < n and text[cut] == '\n' else cut
+    return parts
+
+async def reply_long(message, text):
+    """Отвечает HTML-текстом, разбивая его на сообщения допустимой длины."""
+    for part in split_for_telegram(text):
+        await message.reply_text(part, parse_mode='HTML')
+
+def format_report(title, items):
+    """Собирает HTML-отчет по найденным банкротствам (общий для /check и рассылки)."""
+    parts = [f"🚨 <b>{title} ({len(items)}):</b>\n\n"]
+    for i, item in enumerate(items, 1):
+        safe_name = html.escape(item['name'])
+        parts.append(f"{i}. 🆔 <b>{item['code']}</b>\n🏢 {safe_name}\n📅 {item['date']}\n\n")
+    return "".join(parts)
+
 # --- ХЕНДЛЕРЫ ---
 
 #async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -325,19 +798,13 @@ async def import_txt_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     chat_id = update.effective_chat.id
-    added_count = 0
-    total_found = 0
     
     await update.message.reply_text("? Начинаю импорт из файла...")
 
     try:
-        with open(COMPANIES_FILE_TXT, 'r', encoding='utf-8') as f:
-            for line in f:
-                code = line.strip()
-                if code and code.isdigit():
-                    total_found += 1
-                    if db_add_subscription(chat_id, code):
-                        added_count += 1
+        codes = get_txt_codes()
+        total_found = len(codes)
+        added_count = await asyncio.to_thread(db_add_subscriptions, chat_id, codes)
         
         await update.message.reply_text(
             f"? <b>Импорт завершен!</b>\n\n"
@@ -415,16 +882,16 @@ async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔕 Розсилка відключена.", parse_mode='HTML')
 
 async def my_companies(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    codes = db_get_user_subscriptions(update.effective_chat.id)
+    codes = await asyncio.to_thread(db_get_user_subscriptions, update.effective_chat.id)
     if not codes:
         await update.message.reply_text("📭 Ваш список порожній.")
         return
     text = f"📋 <b>Ваш список ({len(codes)} шт):</b>\n" + "\n".join(f"• <code>{c}</code>" for c in codes)
-    await update.message.reply_text(text, parse_mode='HTML')
+    await reply_long(update.message, text)
 
 async def clear_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    with sqlite3.connect(DB_FILE) as conn:
+    with db_connect() as conn:
         conn.execute("DELETE FROM sent_history WHERE chat_id = ?", (chat_id,))
     await update.message.reply_text("🧹 Ваша історія переглядів очищена.")
 
@@ -437,18 +904,13 @@ async def check_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else: await update.message.reply_text("✅ По вашому списку нових банкрутств немає.")
         return
 
-    text = f"🚨 <b>НОВІ ПОДІЇ ({len(items)}):</b>\n\n"
-    for i, item in enumerate(items, 1):
-        safe_name = html.escape(item['name'])
-        text += f"{i}. 🆔 <b>{item['code']}</b>\n🏢 {safe_name}\n📅 {item['date']}\n\n"
-    
-    await update.message.reply_text(text, parse_mode='HTML')
+    await reply_long(update.message, format_report("НОВІ ПОДІЇ", items))
 
 async def manual_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("⏳ Оновлюю загальну базу...")
-    res, msg = await asyncio.to_thread(update_database_logic)
+    res, msg = await refresh_database(force=True)
     if res:
-        await update.message.reply_text("✅ База оновлена. Перевіряю ваші підписки...")
+        await update.message.reply_text(f"✅ {msg} Перевіряю ваші підписки...")
         await check_command(update, context)
     else:
         await update.message.reply_text(f"❌ {msg}")
@@ -468,19 +930,15 @@ async def find_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Логика поиска в БД
     def db_search(c):
-        if not os.path.exists(DB_FILE): return "База не скачана."
-        with sqlite3.connect(DB_FILE) as conn:
-            rows = conn.execute("SELECT firm_name, date FROM bankrupts WHERE firm_edrpou = ?", (c,)).fetchall()
+        rows = db_read("SELECT firm_name, date FROM bankrupts WHERE firm_edrpou = ?", (c,))
         if not rows: return f"✅ По коду {c} нічого не знайдено."
-        res = f"🔎 <b>Результати по {c}:</b>\n"
-        for n, d in rows: 
-            safe_n = html.escape(n)
-            res += f"\n- {safe_n} ({d})"
-        return res
+        parts = [f"🔎 <b>Результати по {c}:</b>\n"]
+        parts.extend(f"\n- {html.escape(n)} ({d})" for n, d in rows)
+        return "".join(parts)
 
     await update.message.reply_text("⏳ Шукаю...")
     result = await asyncio.to_thread(db_search, code)
-    await update.message.reply_text(result, parse_mode='HTML')
+    await reply_long(update.message, result)
     
     # Завершаем разговор
     return ConversationHandler.END
@@ -492,10 +950,40 @@ async def cancel_operation(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- ЕЖЕДНЕВНАЯ ЗАДАЧА (МАССОВАЯ РАССЫЛКА) ---
 
+async def send_with_retry(bot, chat_id, text, attempts=3):
+    """Отправляет HTML-сообщение, выжидая паузу, если Telegram ответил RetryAfter (flood control)."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return await bot.send_message(chat_id, text, parse_mode='HTML')
+        except RetryAfter as e:
+            if attempt == attempts:
+                raise
+            logging.warning(f"⚠️ Flood control для {chat_id}, ждем {e.retry_after} с.")
+            await asyncio.sleep(e.retry_after)
+
+class RateLimiter:
+    """Равномерно распределяет вызовы wait() во времени: не чаще rate раз в секунду."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+async def startup_refresh(context: ContextTypes.DEFAULT_TYPE):
+    """Загружает реестр сразу после старта, если его нет или он в старом формате."""
+    res, msg = await refresh_database()
+    if not res:
+        logging.error(f"❌ Не удалось загрузить реестр при старте: {msg}")
+
 async def daily_routine(context: ContextTypes.DEFAULT_TYPE):
     logging.info("Start daily routine")
     
-    res, msg = await asyncio.to_thread(update_database_logic)
+    res, msg = await refresh_database()
     if not res:
         try:
             await context.bot.send_message(
@@ -507,38 +995,75 @@ async def daily_routine(context: ContextTypes.DEFAULT_TYPE):
         return
 
     users = await asyncio.to_thread(db_get_active_users)
-    is_monday = (datetime.datetime.now().weekday() == 0)
-    
-    for chat_id in users:
+    # Все пользователи проверяются одним запросом к БД с одним коммитом истории.
+    # Сбой (например, database is locked) срывает рассылку всем — пробуем еще раз
+    # и, если не вышло, сообщаем админу так же, как об ошибке обновления
+    for attempt in range(1, 3):
         try:
-            items, _ = await asyncio.to_thread(check_user_subscriptions, chat_id, save_history=True)
-            message = None
-            if items:
-                message = f"🚨 <b>НОВІ БАНКРУТСТВА ({len(items)}):</b>\n\n"
-                for i, item in enumerate(items, 1):
-                    safe_name = html.escape(item['name'])
-                    message += f"{i}. 🆔 <b>{item['code']}</b>\n🏢 {safe_name}\n📅 {item['date']}\n\n"
-            elif is_monday:
-                message = "👋 <b>Понедельник.</b>\nБот работает. По вашему списку компаний новых банкротств нет."
-            
-            if message:
-                await context.bot.send_message(chat_id, message, parse_mode='HTML')
-                
+            user_items = await asyncio.to_thread(check_users_subscriptions, users)
+            break
         except Exception as e:
-            logging.error(f"Error checking for user {chat_id}: {e}")
+            logging.error(f"Error checking subscriptions (attempt {attempt}/2): {e}")
+            if attempt == 2:
+                try:
+                    await context.bot.send_message(
+                        ADMIN_CHAT_ID,
+                        f"⚠️ <b>Ошибка утренней проверки подписок!</b>\nРассылка не выполнена.\n{html.escape(str(e))}",
+                        parse_mode='HTML'
+                    )
+                except: pass
+                return
+            await asyncio.sleep(30)
+    # После дневной записи истории освежаем статистику планировщика (сбой не критичен)
+    try:
+        await asyncio.to_thread(db_analyze_users)
+    except Exception as e:
+        logging.warning(f"⚠️ ANALYZE не выполнен: {e}")
+    is_monday = (datetime.datetime.now().weekday() == 0)
+    # Ограничиваем число одновременных отправок (лимиты Telegram)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    limiter = RateLimiter(BROADCAST_RATE)
+
+    async def notify_user(chat_id):
+        async with semaphore:
+            try:
+                items = user_items[chat_id]
+                message = None
+                if items:
+                    message = format_report("НОВІ БАНКРУТСТВА", items)
+                elif is_monday:
+                    message = "👋 <b>Понедельник.</b>\nБот работает. По вашему списку компаний новых банкротств нет."
+                
+                if message:
+                    for part in split_for_telegram(message):
+                        await limiter.wait()
+                        await send_with_retry(context.bot, chat_id, part)
+                    
+            except Forbidden:
+                # Пользователь заблокировал бота — больше не тратим на него рассылку
+                logging.info(f"User {chat_id} blocked the bot, deactivating.")
+                await asyncio.to_thread(db_set_user_active, chat_id, False)
+            except Exception as e:
+                logging.error(f"Error sending to user {chat_id}: {e}")
+
+    # Рассылка идет параллельно, а не по одному пользователю за раз
+    await asyncio.gather(*(notify_user(chat_id) for chat_id in users))
 
 # --- ЗАПУСК ---
 
 if __name__ == '__main__':
     if not TOKEN: exit("NO TOKEN")
     
-    init_db()
+    needs_refresh = init_db()
+    load_resource_url_cache()
     
-    app = ApplicationBuilder().token(TOKEN).build()
+    app = ApplicationBuilder().token(TOKEN).post_shutdown(shutdown_resources).build()
     
     jq = app.job_queue
     kyiv_tz = pytz.timezone('Europe/Kiev')
     jq.run_daily(daily_routine, time=datetime.time(hour=9, minute=0, tzinfo=kyiv_tz))
+    if needs_refresh:
+        jq.run_once(startup_refresh, when=0)
     
     # Обычные команды
     app.add_handler(CommandHandler("start", start))